@@ -3,8 +3,15 @@ import pdfplumber
 import pandas as pd
 import re
 import io
+import os
+import threading
+from concurrent.futures import ThreadPoolExecutor, as_completed
 from datetime import datetime
-import pytesseract
+
+# Pages are OCR'd in parallel threads, so stop each Tesseract call from also
+# spawning its own OpenMP threads (must be set before tesserocr is loaded)
+os.environ.setdefault("OMP_THREAD_LIMIT", "1")
+from tesserocr import PyTessBaseAPI, PSM, get_languages
 from pdf2image import convert_from_bytes
 from PIL import Image
 
@@ -83,91 +90,191 @@ HEADER_PATTERNS = [
     "MONETARY POLITICAL CONTRIBUTIONS"
 ]
 
-def is_footer_text(text):
-    """Check if text contains footer patterns"""
-    if not text:
-        return False
-    text_lower = text.lower()
-    for pattern in FOOTER_PATTERNS:
-        if pattern.lower() in text_lower:
-            return True
-    return False
+# Footer and header text as regex alternations
+# (footers match case-insensitively, headers exactly)
+FOOTER_ALTERNATION = '(?i:' + '|'.join(re.escape(p) for p in FOOTER_PATTERNS) + ')'
+HEADER_ALTERNATION = '|'.join(re.escape(p) for p in HEADER_PATTERNS)
 
-def is_header_text(text):
-    """Check if text contains header patterns"""
-    if not text:
-        return False
-    for pattern in HEADER_PATTERNS:
-        if pattern in text:
-            return True
-    return False
+# Address-line shapes
+STREET_PATTERN = r'^\d+\s+[A-Za-z]'  # "123 Main St" or similar
+CITY_STATE_PATTERN = r'^[A-Za-z\s]+,\s*[A-Z]{2}$'  # "City, ST" without zip
+STATE_ZIP_PATTERN = r'^[A-Z]{2}\s+\d{5}'  # "TX 77027" or similar
+
+# Precompiled regexes used while parsing contribution lines
+# Date, Name, and Amount on one line ($ optional for OCR robustness)
+DATE_NAME_AMOUNT_RE = re.compile(r'(\d{2}/\d{2}/\d{4})\s+(.+?)\s+\$?([\d,]+\.\d{2})')
+# Looser form used to find where the next contribution starts
+DATE_AMOUNT_RE = re.compile(r'\d{2}/\d{2}/\d{4}\s+.*?\d+\.\d{2}')
+DATE_RE = re.compile(r'\d{2}/\d{2}/\d{4}')
+DECIMAL_AMOUNT_RE = re.compile(r'\d+\.\d{2}')
+ID_STRIP_RE = re.compile(r'\(ID#:.*?\)')
+# Removes header text caught up in occupation/employer values
+HEADER_STRIP_RE = re.compile(HEADER_ALTERNATION)
+
+# Any of the four address-line shapes in a single pass
+ADDR_ANY_RE = re.compile(
+    r'(?P<full>,.*[A-Z]{2}\s+\d|[A-Z]{2}\s+\d.*,)'  # Complete address with city, state, zip
+    '|(?P<street>' + STREET_PATTERN + ')'  # Street address (starts with number)
+    '|(?P<citystate>' + CITY_STATE_PATTERN + ')'  # City, State (without zip)
+    '|(?P<statezip>' + STATE_ZIP_PATTERN + ')'  # Just state and zip
+)
+ADDR_FULL_RE = re.compile(r'([A-Za-z\s]+),\s*([A-Z]{2})\s*(\d{5}(?:-\d{4})?)')
+
+# Every regex check in should_skip_line combined into one pattern, so each
+# line is scanned once for footer/header text and address-like shapes
+SKIP_LINE_RE = re.compile('|'.join([
+    FOOTER_ALTERNATION,
+    HEADER_ALTERNATION,
+    STREET_PATTERN,
+    CITY_STATE_PATTERN,
+    STATE_ZIP_PATTERN,
+]))
 
 def should_skip_line(text):
     """Determine if a line should be skipped when looking for occupation/employer"""
     if not text or text.strip() == "":
         return True
-    if is_footer_text(text):
-        return True
-    if is_header_text(text):
-        return True
-    if re.match(r'^\d+\.\d+$', text):  # Page numbers like "1.0"
-        return True
-    if re.match(r'^Sch:.*Rpt:', text):  # "Sch: 1/5 Rpt: 4/23"
+    if SKIP_LINE_RE.search(text):  # Footer/header text or an address-like line
         return True
-    if re.match(r'^\d+ of \d+$', text):  # "3 of 23"
+    # Page furniture, checked with plain string methods rather than regexes
+    whole, dot, fraction = text.partition('.')
+    if dot and whole.isdecimal() and fraction.isdecimal():  # Page numbers like "1.0"
         return True
-    
-    # Additional checks for address-like patterns
-    # Check for street address patterns
-    if re.match(r'^\d+\s+[A-Za-z]', text):  # "123 Main St" or similar
-        return True
-    if re.match(r'^[A-Za-z\s]+,\s*[A-Z]{2}$', text):  # "City, ST" without zip
+    if text.startswith('Sch:') and 'Rpt:' in text:  # "Sch: 1/5 Rpt: 4/23"
         return True
-    if re.match(r'^[A-Z]{2}\s+\d{5}', text):  # "TX 77027" or similar
+    page, of, pages = text.partition(' of ')
+    if of and page.isdecimal() and pages.isdecimal():  # "3 of 23"
         return True
     
     return False
 
-def get_text_from_page(page, pdf_bytes, page_num):
-    """
-    Try to extract text normally. If empty, perform OCR.
-    """
-    # 1. Try native extraction (fast, accurate for digital PDFs)
+# Line labels set by classify_line (bit flags, a line can carry several)
+LINE_DATE = 1  # Date and amount, i.e. the start of a contribution
+LINE_ADDRESS = 2  # Looks like part of an address
+LINE_SKIP = 4  # Can't be occupation/employer data
+
+def classify_line(line):
+    """Label a line once so the scans after each contribution don't re-run the same regexes"""
+    kind = 0
+    if '/' in line and DATE_AMOUNT_RE.search(line):
+        kind |= LINE_DATE
+    if ADDR_ANY_RE.search(line):
+        kind |= LINE_ADDRESS
+    # Date and address lines are never occupation/employer data, nor are
+    # headers, footers or anything else with a date and an amount
+    if (kind or should_skip_line(line)
+            or ('/' in line and DATE_RE.search(line) and DECIMAL_AMOUNT_RE.search(line))):
+        kind |= LINE_SKIP
+    return kind
+
+# Resolution scanned pages are rendered at for OCR. 200 DPI reads these forms as
+# well as 300 DPI with well under half the pixels for Tesseract to process
+OCR_DPI = 200
+
+# tesserocr wheels bundle a libtesseract with no tessdata prefix compiled in, so
+# point it at the system language data: TESSDATA_PREFIX if set, otherwise where
+# Debian's tesseract-ocr package installs it
+# (tesserocr needs the trailing slash)
+TESSDATA_PATH = os.path.join(os.environ.get("TESSDATA_PREFIX", "/usr/share/tesseract-ocr/5/tessdata"), "")
+
+# Per-thread Tesseract handles for the OCR workers
+_ocr_thread = threading.local()
+
+def ocr_available():
+    """Check that Tesseract can find its English language data"""
+    try:
+        _, languages = get_languages(TESSDATA_PATH)
+    except RuntimeError:
+        # Raised when the tessdata folder doesn't exist
+        return False
+    return 'eng' in languages
+
+def open_ocr_api():
+    """Open a Tesseract handle, or return None if Tesseract is unavailable"""
     try:
-        text = page.extract_text()
-    except:
-        text = ""
+        # PSM.SINGLE_BLOCK (--psm 6) assumes a single uniform block of text
+        return PyTessBaseAPI(path=TESSDATA_PATH, psm=PSM.SINGLE_BLOCK)
+    except RuntimeError as e:
+        print(f"OCR unavailable: {e}")
+        return None
+
+def get_ocr_api():
+    """Return this thread's Tesseract handle, opening it on first use"""
+    # Handles are not thread-safe, so each OCR worker thread keeps its own
+    if not hasattr(_ocr_thread, 'api'):
+        _ocr_thread.api = open_ocr_api()
+    return _ocr_thread.api
+
+def get_native_text(page, page_num):
+    """Extract the embedded text of a page (fast, accurate for digital PDFs)"""
+    try:
+        return page.extract_text() or ""
+    except Exception as e:
+        # Malformed page content; treat it as having no text layer
+        print(f"Text extraction failed for page {page_num}: {e}")
+        return ""
+
+def needs_ocr(text):
+    """Pages without substantial native text are treated as scanned"""
+    return len(text.strip()) <= 50
+
+def binarize_image(image):
+    """Convert a page image to 1-bit black and white using Otsu's threshold"""
+    gray = image if image.mode == 'L' else image.convert('L')
+    histogram = gray.histogram()
+    total = sum(histogram)
+    sum_all = sum(value * count for value, count in enumerate(histogram))
     
-    # 2. If text is found and looks substantial, return it
-    if text and len(text.strip()) > 50:
-        return text
+    # Pick the threshold that maximises the variance between ink and paper
+    threshold = 0
+    best_variance = 0
+    weight_dark = 0
+    sum_dark = 0
+    for value, count in enumerate(histogram):
+        weight_dark += count
+        weight_light = total - weight_dark
+        if weight_dark == 0:
+            continue
+        if weight_light == 0:
+            break
+        sum_dark += value * count
+        mean_dark = sum_dark / weight_dark
+        mean_light = (sum_all - sum_dark) / weight_light
+        variance = weight_dark * weight_light * (mean_dark - mean_light) ** 2
+        if variance > best_variance:
+            best_variance = variance
+            threshold = value
+    
+    return gray.point(lambda p: 255 if p > threshold else 0, mode='1')
 
-    # 3. Fallback: OCR (Scanned PDF)
-    # Note: This requires Tesseract and Poppler installed on the system
+def ocr_page(image, page_num, dpi=OCR_DPI):
+    """
+    Run OCR on a rendered page image. Safe to call from worker threads.
+    """
+    # Note: This requires Tesseract installed on the system
+    api = get_ocr_api()
+    if api is None:
+        return ""
     try:
-        # Convert specific page to image (page_num is 0-indexed, pdf2image uses 1-indexed)
-        images = convert_from_bytes(
-            pdf_bytes, 
-            first_page=page_num+1, 
-            last_page=page_num+1,
-            dpi=300
-        )
-        
-        if images:
-            # Use Tesseract to get text
-            # --psm 6 assumes a single uniform block of text
-            ocr_text = pytesseract.image_to_string(images[0], config='--psm 6') 
-            return ocr_text
+        # Reuse this thread's Tesseract handle instead of starting a new process.
+        # A 1-bit image lets Leptonica use its fast binary paths and skips
+        # Tesseract's own thresholding
+        api.SetImage(binarize_image(image))
+        # The rendered image carries no resolution, so state it explicitly
+        # rather than letting Tesseract guess
+        api.SetSourceResolution(dpi)
+        ocr_text = api.GetUTF8Text()
+        return ocr_text
     except Exception as e:
-        # If OCR fails (usually missing dependencies), return empty string so the loop continues
+        # If OCR fails, return empty string so the loop continues
         print(f"OCR Failed for page {page_num}: {e}")
         return ""
-    
-    return ""
 
-def extract_schedule_a1_from_pdf(pdf_file):
+def extract_schedule_a1_from_pdf(pdf_file, ocr_dpi=OCR_DPI):
     """Extract Schedule A1 data from uploaded PDF (Digital or Scanned)"""
-    all_contributions = []
+    # Keyed by (date, name, amount) so duplicates are dropped as they are found,
+    # keeping the first occurrence in page order
+    all_contributions = {}
     
     try:
         # Get raw bytes for OCR usage
@@ -181,15 +288,80 @@ def extract_schedule_a1_from_pdf(pdf_file):
             progress_bar = st.progress(0)
             status_text = st.empty()
             
-            for page_num in range(total_pages):
+            # 1. Native extraction for every page, noting which ones look scanned
+            page_texts = []
+            for page_num, page in enumerate(pdf.pages):
                 # Update progress
-                status_text.text(f"Processing page {page_num + 1} of {total_pages}...")
+                status_text.text(f"Reading page {page_num + 1} of {total_pages}...")
                 progress_bar.progress((page_num + 1) / total_pages)
                 
-                page = pdf.pages[page_num]
+                page_texts.append(get_native_text(page, page_num))
                 
-                # Intelligent Extraction (Native or OCR)
-                text = get_text_from_page(page, pdf_bytes, page_num)
+                # Only the text is needed from here on, so release the page's
+                # cached chars/objects instead of holding every page in memory
+                page.flush_cache()
+            
+            ocr_page_nums = [n for n, text in enumerate(page_texts) if needs_ocr(text)]
+            
+            # Tell the user rather than silently returning no text for scanned pages
+            if ocr_page_nums and not ocr_available():
+                st.warning(
+                    f"⚠️ OCR unavailable: no Tesseract language data found in {TESSDATA_PATH}. "
+                    f"{len(ocr_page_nums)} scanned page(s) were skipped. "
+                    "Install tesseract-ocr or set TESSDATA_PREFIX to its tessdata folder."
+                )
+                ocr_page_nums = []
+            
+            # 2. Render only the scanned pages, then OCR them concurrently with
+            # one Tesseract handle per thread. tesserocr releases the GIL while
+            # recognising, so pages run in parallel.
+            if ocr_page_nums:
+                workers = min(len(ocr_page_nums), os.cpu_count() or 1)
+                batch_size = 2 * workers
+                
+                # Group consecutive scanned pages into batches so each one is
+                # rendered in one pdftoppm call (rather than re-parsing the PDF
+                # once per page) and digital pages in between are never rendered.
+                # Batches are capped so only a few page bitmaps are in memory at once.
+                batches = []
+                for n in ocr_page_nums:
+                    if batches and n == batches[-1][-1] + 1 and len(batches[-1]) < batch_size:
+                        batches[-1].append(n)
+                    else:
+                        batches.append([n])
+                
+                done = 0
+                with ThreadPoolExecutor(max_workers=workers) as executor:
+                    for batch in batches:
+                        status_text.text(f"Running OCR on scanned pages ({done} of {len(ocr_page_nums)})...")
+                        try:
+                            # Note: This requires Poppler installed on the system
+                            # (pdf2image uses 1-indexed page numbers)
+                            images = convert_from_bytes(
+                                pdf_bytes,
+                                first_page=batch[0] + 1,
+                                last_page=batch[-1] + 1,
+                                dpi=ocr_dpi,
+                                grayscale=True
+                            )
+                        except Exception as e:
+                            print(f"Rendering pages {batch[0]}-{batch[-1]} for OCR failed: {e}")
+                            done += len(batch)
+                            continue
+                        
+                        futures = {executor.submit(ocr_page, image, n, ocr_dpi): n for n, image in zip(batch, images)}
+                        # Drop this batch's bitmaps before the next one is rendered
+                        del images
+                        
+                        for future in as_completed(futures):
+                            done += 1
+                            status_text.text(f"Running OCR on scanned pages ({done} of {len(ocr_page_nums)})...")
+                            progress_bar.progress(done / len(ocr_page_nums))
+                            page_texts[futures[future]] = future.result()
+            
+            # 3. Parse the contributions out of each page's text
+            for page_num in range(total_pages):
+                text = page_texts[page_num]
                 
                 if not text:
                     continue
@@ -199,15 +371,22 @@ def extract_schedule_a1_from_pdf(pdf_file):
                     
                     # Split into lines and clean
                     lines = [line.strip() for line in text.split('\n') if line.strip()]
+                    line_kinds = [classify_line(line) for line in lines]
                     
                     i = 0
                     while i < len(lines):
                         line = lines[i]
                         
+                        # Every contribution line carries a date, so skip the
+                        # regex entirely when there is no '/' on the line
+                        if '/' not in line:
+                            i += 1
+                            continue
+                        
                         # Regex to find the start of a contribution
                         # Looks for Date, Name, and Amount on one line
                         # Modified to make $ optional (\$) for OCR robustness
-                        date_match = re.search(r'(\d{2}/\d{2}/\d{4})\s+(.+?)\s+\$?([\d,]+\.\d{2})', line)
+                        date_match = DATE_NAME_AMOUNT_RE.search(line)
                         
                         if date_match:
                             date = date_match.group(1)
@@ -216,7 +395,7 @@ def extract_schedule_a1_from_pdf(pdf_file):
                             
                             # Clean name
                             name = name_and_maybe_more
-                            name = re.sub(r'\(ID#:.*?\)', '', name).strip()
+                            name = ID_STRIP_RE.sub('', name).strip()
                             
                             # Initialize variables
                             address = "No Data"
@@ -244,25 +423,7 @@ def extract_schedule_a1_from_pdf(pdf_file):
                                         continue
                                 
                                 # Check for address patterns
-                                is_address_line = False
-                                
-                                # Pattern 1: Complete address with city, state, zip
-                                if ',' in test_line and re.search(r'[A-Z]{2}\s+\d', test_line):
-                                    is_address_line = True
-                                
-                                # Pattern 2: Street address (starts with number)
-                                elif re.match(r'^\d+\s+[A-Za-z]', test_line):
-                                    is_address_line = True
-                                
-                                # Pattern 3: City, State (without zip)
-                                elif re.match(r'^[A-Za-z\s]+,\s*[A-Z]{2}$', test_line):
-                                    is_address_line = True
-                                
-                                # Pattern 4: Just state and zip
-                                elif re.match(r'^[A-Z]{2}\s+\d{5}', test_line):
-                                    is_address_line = True
-                                
-                                if is_address_line:
+                                if line_kinds[i + j] & LINE_ADDRESS:
                                     address_lines.append(test_line)
                                 elif address_lines:
                                     # If we already started collecting address lines and this doesn't look like address, stop
@@ -274,7 +435,7 @@ def extract_schedule_a1_from_pdf(pdf_file):
                                 
                                 # Try to parse the complete address
                                 # Look for city, state, zip pattern in the combined address
-                                addr_match = re.search(r'([A-Za-z\s]+),\s*([A-Z]{2})\s*(\d{5}(?:-\d{4})?)', address)
+                                addr_match = ADDR_FULL_RE.search(address)
                                 if addr_match:
                                     city = addr_match.group(1).strip()
                                     state = addr_match.group(2).strip()
@@ -291,6 +452,7 @@ def extract_schedule_a1_from_pdf(pdf_file):
                                             zipcode = sz_parts[1]
                             
                             # MODIFIED: Skip address lines when searching for occupation/employer
+                            address_line_set = set(address_lines)
                             address_line_count = len(address_lines)
                             search_start = i + address_line_count + 1
                             search_end = min(i + 15, len(lines))
@@ -298,7 +460,7 @@ def extract_schedule_a1_from_pdf(pdf_file):
                             # Look for next contribution to know where to stop
                             next_contribution_idx = -1
                             for j in range(search_start, min(i + 20, len(lines))):
-                                if re.search(r'\d{2}/\d{2}/\d{4}\s+.*?\d+\.\d{2}', lines[j]):
+                                if line_kinds[j] & LINE_DATE:
                                     next_contribution_idx = j
                                     search_end = min(search_end, next_contribution_idx)
                                     break
@@ -308,20 +470,12 @@ def extract_schedule_a1_from_pdf(pdf_file):
                             for j in range(search_start, search_end):
                                 test_line = lines[j]
                                 
-                                # Use helper to skip headers, footers
-                                if should_skip_line(test_line):
+                                # Skip headers, footers, dates/amounts and address-like lines
+                                if line_kinds[j] & LINE_SKIP:
                                     continue
                                 
                                 # Skip if this line was part of address
-                                if address_lines and test_line in address_lines:
-                                    continue
-                                
-                                # Skip lines that look like dates/amounts
-                                if re.search(r'\d{2}/\d{2}/\d{4}', test_line) and re.search(r'\d+\.\d{2}', test_line):
-                                    continue
-                                
-                                # Skip lines that look like addresses
-                                if ',' in test_line and re.search(r'[A-Z]{2}\s+\d', test_line):
+                                if test_line in address_line_set:
                                     continue
                                 
                                 potential_data_lines.append(test_line)
@@ -342,11 +496,10 @@ def extract_schedule_a1_from_pdf(pdf_file):
                                     employer = potential_data_lines[1]
                             
                             # Final cleanup
-                            for pattern in HEADER_PATTERNS:
-                                if occupation: 
-                                    occupation = occupation.replace(pattern, "").strip()
-                                if employer: 
-                                    employer = employer.replace(pattern, "").strip()
+                            if occupation: 
+                                occupation = HEADER_STRIP_RE.sub("", occupation).strip()
+                            if employer: 
+                                employer = HEADER_STRIP_RE.sub("", employer).strip()
                             
                             if occupation in ["()", "(", ")", "No Data"]: 
                                 occupation = "No Data"
@@ -357,7 +510,7 @@ def extract_schedule_a1_from_pdf(pdf_file):
                             if not employer: 
                                 employer = "No Data"
                             
-                            all_contributions.append({
+                            all_contributions.setdefault((date, name, amount), {
                                 'Date': date,
                                 'Contributor Name': name,
                                 # 'Address': address,
@@ -375,7 +528,7 @@ def extract_schedule_a1_from_pdf(pdf_file):
                             
                             # Try to find the next date line to skip accurately
                             for j in range(i + skip_amount, min(i + 10, len(lines))):
-                                if re.search(r'\d{2}/\d{2}/\d{4}\s+.*?\d+\.\d{2}', lines[j]):
+                                if line_kinds[j] & LINE_DATE:
                                     skip_amount = j - i
                                     break
                             
@@ -387,16 +540,7 @@ def extract_schedule_a1_from_pdf(pdf_file):
             status_text.empty()
             progress_bar.empty()
 
-        # Remove duplicates
-        unique_contributions = []
-        seen = set()
-        for contrib in all_contributions:
-            key = (contrib['Date'], contrib['Contributor Name'], contrib['Amount'])
-            if key not in seen:
-                seen.add(key)
-                unique_contributions.append(contrib)
-        
-        return unique_contributions, None
+        return list(all_contributions.values()), None
         
     except Exception as e:
         return None, f"Error processing PDF: {str(e)}"
@@ -442,7 +586,7 @@ def main():
                     df = pd.DataFrame(contributions)
                     
                     # Sort by date and page
-                    df['Date'] = pd.to_datetime(df['Date'], format='%m/%d/%Y', errors='coerce')
+                    df['Date'] = pd.to_datetime(df['Date'], format='%m/%d/%Y', errors='coerce', cache=True)
                     df = df.sort_values(['Date', 'Page'])
                     df = df.drop('Page', axis=1)
                     
@@ -457,14 +601,9 @@ def main():
                     st.markdown('<h3 class="sub-header">📋 Data Preview</h3>', unsafe_allow_html=True)
                     st.dataframe(df.head(10), use_container_width=True)
                     
-                    # Calculate total
-                    total = 0
-                    for amt in df['Amount']:
-                        clean_amt = str(amt).replace('$', '').replace(',', '')
-                        try:
-                            total += float(clean_amt)
-                        except:
-                            pass
+                    # Calculate total (amounts that don't parse count as 0)
+                    clean_amounts = df['Amount'].str.replace('$', '', regex=False).str.replace(',', '', regex=False)
+                    total = pd.to_numeric(clean_amounts, errors='coerce').fillna(0).sum()
                     
                     # Display stats
                     col1, col2, col3 = st.columns(3)
@@ -481,7 +620,7 @@ def main():
                     
                     # Prepare Excel file for download
                     output = io.BytesIO()
-                    with pd.ExcelWriter(output, engine='openpyxl') as writer:
+                    with pd.ExcelWriter(output, engine='xlsxwriter') as writer:
                         df.to_excel(writer, index=False, sheet_name='Schedule_A1')
                     
                     output.seek(0)
@@ -498,10 +637,13 @@ def main():
                     )
                     
                     # Also show CSV option
-                    csv = df.to_csv(index=False).encode('utf-8')
+                    # Written straight into a bytes buffer, skipping the intermediate str copy
+                    csv_output = io.BytesIO()
+                    df.to_csv(csv_output, index=False, encoding='utf-8')
+                    csv_output.seek(0)
                     st.download_button(
                         label="📥 Download CSV File",
-                        data=csv,
+                        data=csv_output,
                         file_name=f"Schedule_A1_Data_{timestamp}.csv",
                         mime="text/csv"
                     )